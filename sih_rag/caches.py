@@ -0,0 +1,163 @@
+# caches.py
+import os
+import hashlib
+import unicodedata
+from collections import Counter, OrderedDict
+from cachetools import Cache, LRUCache
+
+
+def query_cache_key(user_query: str, pdf_path: str, session_id: str) -> bytes:
+    """Hash a normalised query so case/whitespace variants share one entry."""
+    norm = unicodedata.normalize("NFKC", user_query).lower()
+    norm = " ".join(norm.split())
+    return hashlib.blake2b(
+        f"{norm}|{pdf_path}|{session_id}".encode("utf-8"), digest_size=16
+    ).digest()
+
+
+class CountMinSketch:
+    """Approximate per-key access counts in a fixed amount of memory.
+
+    Counters saturate at 15 (4 bits worth) and are halved once enough
+    increments have been recorded, so old popularity fades over time.
+    """
+
+    _SEEDS = (0x9E3779B9, 0x85EBCA6B, 0xC2B2AE35, 0x27D4EB2F)
+    _MAX_COUNT = 15
+
+    def __init__(self, capacity: int):
+        width = 16
+        while width < capacity:
+            width <<= 1
+        self._width = width
+        self._mask = width - 1
+        self._table = bytearray(width * len(self._SEEDS))
+        self._sample_size = 10 * max(capacity, 1)
+        self._additions = 0
+
+    def _slots(self, key):
+        h = hash(key)
+        for row, seed in enumerate(self._SEEDS):
+            yield row * self._width + ((((h ^ seed) * 0x9E3779B97F4A7C15) >> 17) & self._mask)
+
+    def increment(self, key):
+        for slot in self._slots(key):
+            if self._table[slot] < self._MAX_COUNT:
+                self._table[slot] += 1
+        self._additions += 1
+        if self._additions >= self._sample_size:
+            self._reset()
+
+    def estimate(self, key) -> int:
+        return min(self._table[slot] for slot in self._slots(key))
+
+    def _reset(self):
+        self._table = bytearray(count >> 1 for count in self._table)
+        self._additions //= 2
+
+
+class TinyLFUCache(Cache):
+    """LRU cache with TinyLFU admission (O(1) get/set, unlike LFUCache).
+
+    When full, a new key only replaces the least recently used entry if the
+    sketch has seen it at least as often, so one-off keys can't flush out
+    frequently used ones. Rejected items are simply not stored, so only use
+    this where recomputing a rejected value is acceptable.
+
+    Accesses are counted on `key in cache`, the check callers make before
+    reading or filling an entry, so misses count as well as hits.
+    """
+
+    def __init__(self, maxsize, getsizeof=None):
+        super().__init__(maxsize, getsizeof)
+        self._order = OrderedDict()
+        self._sketch = CountMinSketch(maxsize)
+
+    def __contains__(self, key):
+        self._sketch.increment(key)
+        return super().__contains__(key)
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        self._order.move_to_end(key)
+        return value
+
+    def __setitem__(self, key, value):
+        if not super().__contains__(key) and not self.admit(key, value):
+            return
+        super().__setitem__(key, value)
+        self._order[key] = None
+        self._order.move_to_end(key)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        del self._order[key]
+
+    def admit(self, key, value) -> bool:
+        if not self._order or self.currsize + self.getsizeof(value) <= self.maxsize:
+            return True
+        victim = next(iter(self._order))
+        return self._sketch.estimate(key) >= self._sketch.estimate(victim)
+
+    def popitem(self):
+        """Remove and return the least recently used `(key, value)` pair."""
+        try:
+            key = next(iter(self._order))
+        except StopIteration:
+            raise KeyError(f"{type(self).__name__} is empty") from None
+        value = super().__getitem__(key)
+        del self[key]
+        return key, value
+
+    def clear(self):
+        super().clear()
+        self._order.clear()
+
+
+class FileLRUCache(LRUCache):
+    """LRU cache of key -> file path that deletes a file once the last key
+    pointing at it is evicted or deleted. Several keys may share one file
+    (e.g. deduplicated uploads).
+
+    Pass `delete_files=False` when other processes may reference the same
+    files; entries are then only forgotten and the files are left in place.
+    `on_remove(path)` is called when the last key for a path goes away,
+    e.g. to drop any indexes built from it.
+    """
+
+    def __init__(self, maxsize, on_remove=None, delete_files=True):
+        super().__init__(maxsize)
+        self._on_remove = on_remove
+        self._delete_files = delete_files
+        self._refs = Counter()  # path -> number of keys pointing at it
+
+    def __setitem__(self, key, path):
+        old_path = Cache.__getitem__(self, key) if key in self else None
+        self._refs[path] += 1
+        super().__setitem__(key, path)
+        if old_path is not None:
+            self._release(old_path)
+
+    def __delitem__(self, key):
+        path = Cache.__getitem__(self, key)
+        super().__delitem__(key)
+        self._release(path)
+
+    def clear(self):
+        # Go through __delitem__ so every file is released
+        while self:
+            self.popitem()
+
+    def _release(self, path):
+        self._refs[path] -= 1
+        if self._refs[path] > 0:
+            return
+        del self._refs[path]
+        if self._delete_files:
+            try:
+                if os.path.exists(path):
+                    os.remove(path)
+            except OSError as e:
+                print(f"Failed to remove {path}: {e}")
+        if self._on_remove is not None:
+            self._on_remove(path)
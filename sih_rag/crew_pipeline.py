@@ -3,7 +3,8 @@ import numpy as np
 import hashlib
 import time
 from functools import wraps
-from cachetools import LFUCache
+from cachetools import LRUCache
+from caches import TinyLFUCache, query_cache_key
 from dotenv import load_dotenv
 from langchain_community.vectorstores import Chroma
 from langchain_groq import ChatGroq
@@ -11,7 +12,7 @@ from BM25_INDEXER import prepare_bm25_index, bm25_search
 from langchain_community.embeddings import HuggingFaceEmbeddings
 
 # === NEW IMPORTS FOR MEMORY ===
-from langchain.memory import ConversationBufferMemory
+from langchain.memory import ConversationBufferWindowMemory
 
 # === Load Env Vars ===
 load_dotenv()
@@ -32,20 +33,23 @@ embedding_model = HuggingFaceEmbeddings(
 )
 
 # === Caches ===
-pdf_cache = LFUCache(maxsize=10)     # Cache per-PDF indexes
-query_cache = LFUCache(maxsize=100)  # Cache per-query answers
+pdf_cache = LRUCache(maxsize=10)         # Cache per-PDF indexes (always admitted)
+query_cache = TinyLFUCache(maxsize=100)  # Cache per-query answers
 
 
 # === Session-based Memory Manager ===
+MAX_HISTORY_TURNS = 10  # Only the last N user/assistant exchanges are kept
+
 class MemoryManager:
     def __init__(self):
-        self.sessions = {}  # session_id -> ConversationBufferMemory
+        self.sessions = {}  # session_id -> ConversationBufferWindowMemory
 
     def get_memory(self, session_id: str):
         if session_id not in self.sessions:
-            self.sessions[session_id] = ConversationBufferMemory(
+            self.sessions[session_id] = ConversationBufferWindowMemory(
                 memory_key="history",
-                return_messages=True
+                return_messages=True,
+                k=MAX_HISTORY_TURNS,
             )
         return self.sessions[session_id]
 
@@ -65,12 +69,12 @@ def cache_query(func):
     @wraps(func)
     def wrapper(user_query: str, pdf_path: str, session_id="default"):
         # FIXED: Include session_id in cache key
-        cache_key = (user_query, pdf_path, session_id)
+        cache_key = query_cache_key(user_query, pdf_path, session_id)
         if cache_key in query_cache:
-            print(f"✅ Returning cached answer for: {cache_key}")
+            print(f"✅ Returning cached answer for: {user_query!r} ({session_id})")
             return query_cache[cache_key]
 
-        print(f"⚡ Executing pipeline for: {cache_key}")
+        print(f"⚡ Executing pipeline for: {user_query!r} ({session_id})")
         result = func(user_query, pdf_path, session_id=session_id)
         query_cache[cache_key] = result
         return result
@@ -136,13 +140,19 @@ def get_or_create_indexes(pdf_path):
         # Build BM25 index once
         prepare_bm25_index(pdf_path)
 
-    # Precompute embeddings
-    doc_embeddings = [np.array(vec) for vec in embedding_model.embed_documents(texts)]
-    doc_norms = [np.linalg.norm(vec) for vec in doc_embeddings]
+    # Precompute embeddings as one matrix so queries don't restack them
+    if texts:
+        doc_embeddings = np.asarray(embedding_model.embed_documents(texts), dtype=np.float64)
+    else:
+        # No extractable text (e.g. scanned PDF): keep an empty, searchable index
+        doc_embeddings = np.empty((0, 0))
+    doc_norms = np.linalg.norm(doc_embeddings, axis=1)
 
     index_data = {
         "vectordb": vectordb,
         "texts": texts,
+        # passage -> first index in texts, replacing per-query texts.index() scans
+        "text_positions": {text: i for i, text in reversed(list(enumerate(texts)))},
         "doc_embeddings": doc_embeddings,
         "doc_norms": doc_norms,
     }
@@ -156,11 +166,14 @@ def local_rerank(query, texts, doc_embeddings, doc_norms, top_n=5):
     query_emb = np.array(embedding_model.embed_query(query))
     query_norm = np.linalg.norm(query_emb)
 
-    doc_matrix = np.stack(doc_embeddings)
-    sims = doc_matrix @ query_emb
-    sims /= np.array(doc_norms) * query_norm
+    sims = doc_embeddings @ query_emb
+    sims /= doc_norms * query_norm
 
-    top_idx = np.argsort(-sims)[:top_n]
+    top_idx = np.arange(len(sims))
+    if len(sims) > top_n:
+        # Partial selection of the top n instead of sorting every candidate
+        top_idx = np.argpartition(-sims, top_n)[:top_n]
+    top_idx = top_idx[np.argsort(-sims[top_idx], kind="stable")]
     return [texts[i] for i in top_idx]
 
 
@@ -169,6 +182,7 @@ def extract_relevant_clause(pdf_path, user_query, k=6):
     indexes = get_or_create_indexes(pdf_path)
     vectordb = indexes["vectordb"]
     texts = indexes["texts"]
+    text_positions = indexes["text_positions"]
     doc_embeddings = indexes["doc_embeddings"]
     doc_norms = indexes["doc_norms"]
 
@@ -209,15 +223,15 @@ def extract_relevant_clause(pdf_path, user_query, k=6):
     if not combined_passages:
         return "", []
 
-    available_indices = [texts.index(p) for p in combined_passages if p in texts]
+    available_indices = [text_positions[p] for p in combined_passages if p in text_positions]
     if not available_indices:
         return "", []
 
     top_n_passages = local_rerank(
         user_query,
         [texts[i] for i in available_indices],
-        [doc_embeddings[i] for i in available_indices],
-        [doc_norms[i] for i in available_indices],
+        doc_embeddings[available_indices],
+        doc_norms[available_indices],
         top_n=5,
     )
 
@@ -249,11 +263,11 @@ def run_full_pipeline(user_query: str, pdf_path: str, session_id="default"):
     # Format chat history for prompt
     history_text = ""
     if chat_history:
-        history_text = "\n\nConversation History:\n"
-        for msg in chat_history:
-            if hasattr(msg, 'type'):
-                role = "User" if msg.type == "human" else "Assistant"
-                history_text += f"{role}: {msg.content}\n"
+        history_text = "\n\nConversation History:\n" + "\n".join(
+            f"{'User' if msg.type == 'human' else 'Assistant'}: {msg.content}"
+            for msg in chat_history
+            if hasattr(msg, 'type')
+        )
 
     prompt_template = f"""
 You are an intelligent assistant working for the Department of Higher Education (MoE).
@@ -290,6 +304,9 @@ Source Metadata:
     # Add AI response to memory
     memory.chat_memory.add_ai_message(llm_response.content)
 
+    # The window only limits what is loaded; also cap what is stored
+    del memory.chat_memory.messages[:-2 * MAX_HISTORY_TURNS]
+
     # FIXED: Return metadata
     return {
         "answer": llm_response.content,
@@ -1,38 +1,89 @@
 # Modified crew_pipeline.py that works without heavy ML dependencies
 import os
+import re
 import hashlib
+import mmap
+import pickle
+import shutil
+import subprocess
+import tempfile
+import threading
 import time
-from functools import wraps
-from cachetools import LFUCache
+from collections import Counter, deque
+from contextlib import contextmanager
+from functools import lru_cache, wraps
+import numpy as np
+from scipy import sparse
+from cachetools import LRUCache
+from caches import TinyLFUCache, query_cache_key
 from dotenv import load_dotenv
 
 # === Load Env Vars ===
 load_dotenv()
 groq_api_key = os.getenv("GROQ_API_KEY")
 
+# Poppler's pdftotext is the fastest extractor for large PDFs; probe it once
+PDFTOTEXT_BIN = shutil.which("pdftotext")
+
+# Lines repeated on more than this share of pages are headers/footers
+BOILERPLATE_PAGE_RATIO = 0.8
+
+# === BM25+ Parameters ===
+BM25_K1 = 1.2
+BM25_B = 0.75
+BM25_DELTA = 1.0  # BM25+ floor so long documents aren't over-penalised
+TOKEN_RE = re.compile(r"\w+")
+
+# === On-disk Index Cache ===
+INDEX_CACHE_DIR = "./index_cache"
+INDEX_CACHE_VERSION = 4  # Bump whenever the pickled index layout changes
+
 # === Caches ===
-pdf_cache = LFUCache(maxsize=10)     # Cache per-PDF indexes
-query_cache = LFUCache(maxsize=100)  # Cache per-query answers
+pdf_cache = LRUCache(maxsize=10)         # Cache per-PDF indexes (always admitted)
+query_cache = TinyLFUCache(maxsize=100)  # Cache per-query answers
+
+# === LLM Client ===
+_llm = None
+_llm_lock = threading.Lock()
+
+def _get_llm():
+    """Build the Groq client once so its keep-alive connections are reused"""
+    global _llm
+    if _llm is None:
+        with _llm_lock:
+            if _llm is None:
+                from langchain_groq import ChatGroq
+
+                _llm = ChatGroq(
+                    model="llama-3.3-70b-versatile",
+                    temperature=0.0,
+                    max_tokens=800,
+                )
+    return _llm
 
 # === Session-based Memory Manager ===
+MAX_HISTORY_MESSAGES = 20  # Last 10 user/assistant turns are kept per session
+
 class MemoryManager:
     def __init__(self):
         self.sessions = {}  # session_id -> simple dict storage
 
+    @staticmethod
+    def _new_memory():
+        # Bounded so prompt size doesn't grow with session length
+        return {
+            "history": deque(maxlen=MAX_HISTORY_MESSAGES),
+            "messages": []
+        }
+
     def get_memory(self, session_id: str):
         if session_id not in self.sessions:
-            self.sessions[session_id] = {
-                "history": [],
-                "messages": []
-            }
+            self.sessions[session_id] = self._new_memory()
         return self.sessions[session_id]
 
     def reset_memory(self, session_id: str):
         if session_id in self.sessions:
-            self.sessions[session_id] = {
-                "history": [],
-                "messages": []
-            }
+            self.sessions[session_id] = self._new_memory()
             print(f"Memory cleared for session: {session_id}")
         else:
             print(f"No memory found for session: {session_id}")
@@ -43,31 +94,166 @@ memory_manager = MemoryManager()
 def cache_query(func):
     @wraps(func)
     def wrapper(user_query: str, pdf_path: str, session_id="default"):
-        cache_key = (user_query, pdf_path, session_id)
+        cache_key = query_cache_key(user_query, pdf_path, session_id)
         if cache_key in query_cache:
-            print(f"Returning cached answer for: {cache_key}")
+            print(f"Returning cached answer for: {user_query!r} ({session_id})")
             return query_cache[cache_key]
 
-        print(f"Executing pipeline for: {cache_key}")
+        print(f"Executing pipeline for: {user_query!r} ({session_id})")
         result = func(user_query, pdf_path, session_id=session_id)
         query_cache[cache_key] = result
         return result
     return wrapper
 
 # === PDF Loader ===
-def load_pdf_chunks(pdf_path):
-    from pypdf import PdfReader
+def _extract_with_pdftotext(pdf_path):
+    result = subprocess.run(
+        [PDFTOTEXT_BIN, "-q", "-enc", "UTF-8", pdf_path, "-"],
+        capture_output=True,
+        check=True,
+        timeout=60,
+    )
+    # Pages are separated by form feeds, with a trailing one after the last page
+    pages = result.stdout.decode("utf-8", "replace").split("\x0c")
+    if pages and not pages[-1]:
+        pages.pop()
+    return pages
+
+def _extract_with_pymupdf(pdf_path, pdf_buffer=None):
+    import fitz  # PyMuPDF: native text extraction, much faster than pypdf
+    if pdf_buffer is None:
+        doc = fitz.open(pdf_path)
+    else:
+        doc = fitz.open(stream=pdf_buffer, filetype="pdf")
+    # Only keep whitespace; skip the other default extraction flags for speed
+    with doc:
+        return [
+            page.get_text("text", flags=fitz.TEXT_PRESERVE_WHITESPACE)
+            for page in doc
+        ]
+
+def clean_pages(pages):
+    """Drop repeated header/footer lines and pages left with no text.
+
+    Takes and returns `(page_num, text)` pairs so page numbers survive.
+    """
+    page_lines = [text.splitlines() for _, text in pages]
+    boilerplate = set()
+    if len(pages) >= 3:
+        line_counts = Counter(
+            line for lines in page_lines
+            for line in {l.strip() for l in lines if l.strip()}
+        )
+        min_pages = BOILERPLATE_PAGE_RATIO * len(pages)
+        boilerplate = {line for line, count in line_counts.items() if count > min_pages}
+
+    cleaned = []
+    for (page_num, text), lines in zip(pages, page_lines):
+        if boilerplate:
+            text = "\n".join(l for l in lines if l.strip() not in boilerplate)
+        if text.strip():
+            cleaned.append((page_num, text))
+    return cleaned
+
+def load_pdf_chunks(pdf_path, pdf_buffer=None):
+    """Return `(page_num, text)` pairs for the non-empty pages of a PDF"""
     if not os.path.exists(pdf_path):
         print(f"File not found: {pdf_path}")
         return []
 
+    if PDFTOTEXT_BIN:
+        try:
+            texts = _extract_with_pdftotext(pdf_path)
+            return clean_pages(list(enumerate(texts, start=1)))
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired, OSError) as e:
+            print(f"pdftotext failed, falling back to PyMuPDF: {e}")
+
     try:
-        reader = PdfReader(pdf_path)
-        texts = [page.extract_text() or "" for page in reader.pages]
+        texts = _extract_with_pymupdf(pdf_path, pdf_buffer)
     except Exception as e:
         print(f"Error reading PDF: {e}")
         return []
-    return texts
+    return clean_pages(list(enumerate(texts, start=1)))
+
+# === Tokenizer ===
+def tokenize(text):
+    return TOKEN_RE.findall(text.lower())
+
+@lru_cache(maxsize=1024)
+def tokenize_query(query):
+    # Queries repeat across sessions/PDFs, so memoise their (immutable) tokens
+    return tuple(tokenize(query))
+
+# === BM25+ Sparse Index ===
+def build_bm25_index(texts):
+    """Build a CSC doc x term matrix of precomputed BM25+ weights"""
+    vocab = {}  # term -> column
+    rows, cols, tfs = [], [], []
+
+    for doc_id, text in enumerate(texts):
+        term_freqs = Counter(tokenize(text))
+        for term, tf in term_freqs.items():
+            rows.append(doc_id)
+            cols.append(vocab.setdefault(term, len(vocab)))
+            tfs.append(tf)
+
+    tf_matrix = sparse.csr_matrix(
+        (np.array(tfs, dtype=np.float64), (rows, cols)),
+        shape=(len(texts), len(vocab)),
+    )
+    doc_lens = np.asarray(tf_matrix.sum(axis=1)).ravel()
+    avgdl = doc_lens.mean() if len(texts) else 0.0
+    length_norm = BM25_K1 * (1 - BM25_B + BM25_B * doc_lens / (avgdl or 1.0))
+    doc_freqs = np.bincount(tf_matrix.indices, minlength=len(vocab))
+    idf = np.log((len(texts) + 1) / np.maximum(doc_freqs, 1))
+
+    # Weights only depend on the corpus, so fold them in once at build time
+    row_of_nnz = np.repeat(np.arange(len(texts)), np.diff(tf_matrix.indptr))
+    tf = tf_matrix.data
+    tf_matrix.data = idf[tf_matrix.indices] * (
+        tf * (BM25_K1 + 1) / (tf + length_norm[row_of_nnz]) + BM25_DELTA
+    )
+
+    # CSC so a query only slices the columns of its own terms
+    return {"weights": tf_matrix.tocsc(), "vocab": vocab}
+
+# === Disk Cache Helpers ===
+@contextmanager
+def map_pdf(pdf_path):
+    """Yield a read-only memoryview over an mmap of the PDF (None if missing
+    or empty), so hashing and parsing read straight from the page cache."""
+    if not os.path.exists(pdf_path) or os.path.getsize(pdf_path) == 0:
+        yield None
+        return
+    with open(pdf_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        with memoryview(mm) as view:
+            yield view
+
+def _index_cache_path(digest):
+    return os.path.join(INDEX_CACHE_DIR, f"{digest}.v{INDEX_CACHE_VERSION}.pkl")
+
+def load_disk_index(cache_path):
+    try:
+        with open(cache_path, "rb") as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        print(f"Ignoring unreadable index cache {cache_path}: {e}")
+        return None
+
+def save_disk_index(cache_path, index_data):
+    os.makedirs(INDEX_CACHE_DIR, exist_ok=True)
+    # Write to a temp file and rename so readers never see a partial pickle
+    fd, tmp_path = tempfile.mkstemp(dir=INDEX_CACHE_DIR, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(index_data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+    except Exception as e:
+        print(f"Failed to write index cache {cache_path}: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
 
 # === Get/Create Indexes (SIMPLIFIED) ===
 def get_or_create_indexes(pdf_path):
@@ -75,59 +261,84 @@ def get_or_create_indexes(pdf_path):
         print(f"Using cached indexes for {pdf_path}")
         return pdf_cache[pdf_path]
 
-    print(f"Creating simple text index for {pdf_path}")
-    chunks = load_pdf_chunks(pdf_path)
-    texts = [doc for doc in chunks if isinstance(doc, str)]
-
-    # Simple text storage without vector embeddings
+    with map_pdf(pdf_path) as pdf_buffer:
+        # Indexes on disk are keyed by PDF content, so they survive restarts
+        cache_path = None
+        if pdf_buffer is not None:
+            cache_path = _index_cache_path(hashlib.sha256(pdf_buffer).hexdigest())
+            index_data = load_disk_index(cache_path)
+            if index_data is not None:
+                print(f"Loaded BM25 index from disk for {pdf_path}")
+                index_data["pdf_path"] = pdf_path
+                pdf_cache[pdf_path] = index_data
+                return index_data
+
+        print(f"Creating BM25 index for {pdf_path}")
+        chunks = load_pdf_chunks(pdf_path, pdf_buffer)
+    texts = [text for _, text in chunks]
+
+    # Keyword index only, no vector embeddings. Page numbers are kept in a
+    # parallel array so search only touches texts and gathers pages at the end
     index_data = {
         "texts": texts,
-        "pdf_path": pdf_path
+        "pages": np.array([page_num for page_num, _ in chunks], dtype=np.int32),
+        "bm25": build_bm25_index(texts),
     }
+    if cache_path and texts:
+        save_disk_index(cache_path, index_data)
+    index_data["pdf_path"] = pdf_path
 
     pdf_cache[pdf_path] = index_data
     return index_data
 
-# === Simple Text Search ===
-def simple_text_search(query, texts, k=5):
-    """Simple keyword-based search"""
-    query_words = query.lower().split()
-    scored_texts = []
-    
-    for text in texts:
-        text_lower = text.lower()
-        score = sum(1 for word in query_words if word in text_lower)
-        if score > 0:
-            scored_texts.append((score, text))
-    
-    # Sort by score and return top k
-    scored_texts.sort(key=lambda x: x[0], reverse=True)
-    return [text for score, text in scored_texts[:k]]
+# === BM25 Text Search ===
+def simple_text_search(query, bm25, k=5):
+    """BM25+ keyword search as one sparse mat-vec over the query's terms.
+
+    Returns the indices of the top k matching texts and their scores, best first.
+    """
+    vocab = bm25["vocab"]
+    term_counts = Counter(term for term in tokenize_query(query) if term in vocab)
+    if not term_counts:
+        return np.empty(0, dtype=np.intp), np.empty(0)
+
+    cols = [vocab[term] for term in term_counts]
+    counts = np.fromiter(term_counts.values(), dtype=np.float64, count=len(cols))
+    scores = bm25["weights"][:, cols] @ counts
+
+    matched = np.flatnonzero(scores)
+    if len(matched) > k:
+        # Partial selection of the top k instead of sorting every match
+        matched = matched[np.argpartition(-scores[matched], k)[:k]]
+    top = matched[np.argsort(-scores[matched], kind="stable")]
+    return top, scores[top]
 
 # === Extract Relevant Text with Metadata ===
 def extract_relevant_clause(pdf_path, user_query, k=6):
     indexes = get_or_create_indexes(pdf_path)
     texts = indexes["texts"]
 
-    # Simple text search
+    # BM25 text search
     try:
-        relevant_passages = simple_text_search(user_query, texts, k=k)
+        top, scores = simple_text_search(user_query, indexes["bm25"], k=k)
     except Exception as e:
         print("Text search failed:", e)
-        relevant_passages = []
+        top, scores = [], []
 
-    if not relevant_passages:
+    if not len(top):
         return "", []
 
-    # Create mock metadata
-    metadata_info = []
-    for i, passage in enumerate(relevant_passages):
-        metadata_info.append({
+    relevant_passages = [texts[i] for i in top]
+    pdf_name = os.path.basename(pdf_path)
+    metadata_info = [
+        {
             "content": passage,
-            "pdf_name": os.path.basename(pdf_path),
-            "page": f"Page {i+1}",
-            "score": 1.0
-        })
+            "pdf_name": pdf_name,
+            "page": f"Page {page_num}",
+            "score": round(float(score), 4)
+        }
+        for passage, page_num, score in zip(relevant_passages, indexes["pages"][top], scores)
+    ]
 
     return "\n\n".join(relevant_passages), metadata_info
 
@@ -149,20 +360,14 @@ def run_full_pipeline(user_query: str, pdf_path: str, session_id="default"):
     # Format chat history for prompt
     history_text = ""
     if chat_history:
-        history_text = "\n\nConversation History:\n"
-        for msg in chat_history:
-            history_text += f"{msg['role']}: {msg['content']}\n"
+        history_text = "\n\nConversation History:\n" + "\n".join(
+            f"{msg['role']}: {msg['content']}" for msg in chat_history
+        )
 
     # Check if we have Groq API key
     if groq_api_key:
         try:
-            from langchain_groq import ChatGroq
-            
-            llm = ChatGroq(
-                model="llama-3.3-70b-versatile",
-                temperature=0.0,
-                max_tokens=800,
-            )
+            llm = _get_llm()
             
             prompt_template = f"""
 You are an intelligent assistant working for the Department of Higher Education (MoE).
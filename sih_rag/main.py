@@ -1,10 +1,16 @@
 from fastapi import FastAPI, Request, UploadFile, File, Form, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from typing import Dict
+from concurrent.futures import ThreadPoolExecutor
 from crew_pipeline import run_full_pipeline, get_or_create_indexes, reset_memory, pdf_cache
+from caches import FileLRUCache, query_cache_key
 import uvicorn
 import os
+import hashlib
+import multiprocessing
 import tempfile
+import uuid
 import asyncio
 import traceback
 import logging
@@ -20,7 +26,8 @@ logger = logging.getLogger(__name__)
 app = FastAPI(
     title="Insurance Claim Evaluator",
     description="Backend for insurance policy evaluation with session-based memory",
-    version="2.2.0"
+    version="2.2.0",
+    default_response_class=ORJSONResponse
 )
 
 # === Enable CORS ===
@@ -33,7 +40,59 @@ app.add_middleware(
 )
 
 # === PDF Storage ===
-uploaded_pdfs: Dict[str, str] = {}  # pdf_id -> pdf_path
+def forget_pdf_indexes(pdf_path: str):
+    if pdf_path in pdf_cache:
+        del pdf_cache[pdf_path]
+
+UPLOAD_CHUNK_SIZE = 1 << 16  # Uploads are streamed to disk 64KB at a time
+
+# Content-addressed PDF store: <sha256>.pdf, so identical uploads share one file
+PDF_BLOB_DIR = os.environ.get("PDF_BLOB_DIR", "./pdf_blobs")
+os.makedirs(PDF_BLOB_DIR, exist_ok=True)
+
+# Processes spawned by uvicorn (WORKERS > 1 or reload) may share the blob dir
+# with sibling workers, so only a top-level process may delete blobs
+OWNS_BLOB_DIR = multiprocessing.parent_process() is None
+
+def purge_pdf_blobs():
+    """
+    Remove blobs and partial uploads left by previous runs.
+    pdf_ids only live in memory, so nothing can reference them after a restart.
+    """
+    for name in os.listdir(PDF_BLOB_DIR):
+        path = os.path.join(PDF_BLOB_DIR, name)
+        try:
+            os.remove(path)
+        except OSError as e:
+            logger.warning(f"⚠️ Could not remove stale blob {path}: {e}")
+
+if OWNS_BLOB_DIR:
+    purge_pdf_blobs()
+
+# pdf_id -> pdf_path; identical uploads get their own pdf_id but share one
+# blob, which is removed once its last pdf_id is evicted or deleted (worker
+# processes leave it for the next startup purge instead)
+uploaded_pdfs = FileLRUCache(
+    maxsize=int(os.environ.get("MAX_UPLOADED_PDFS", 1000)),
+    on_remove=forget_pdf_indexes,
+    delete_files=OWNS_BLOB_DIR,
+)
+
+# === Pipeline Executor ===
+# Dedicated threads for the blocking RAG pipeline (PDF parse + Groq call) so
+# slow LLM calls can't starve the default executor used for other work
+pipeline_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("PIPELINE_WORKERS", 8)),
+    thread_name_prefix="pipeline",
+)
+
+@app.on_event("shutdown")
+def shutdown_pipeline_executor():
+    pipeline_executor.shutdown(wait=False, cancel_futures=True)
+
+# === In-flight Queries ===
+# Identical concurrent queries share one pipeline run (and one Groq call)
+inflight_queries: Dict[bytes, asyncio.Future] = {}
 
 # === Health Check ===
 @app.get("/")
@@ -64,30 +123,54 @@ async def upload_pdf(file: UploadFile = File(...)):
         if not file.filename.endswith('.pdf'):
             raise HTTPException(status_code=400, detail="❌ Only PDF files allowed")
         
-        # Read file content
-        content = await file.read()
-        
-        # Validate file size (max 10MB)
+        # Stream to a temporary file, enforcing the size limit (max 10MB) and
+        # hashing the content as we go
         max_size = 10 * 1024 * 1024  # 10MB
-        if len(content) > max_size:
+        size = 0
+        digest = hashlib.sha256()
+        with tempfile.NamedTemporaryFile(delete=False, suffix=".tmp", dir=PDF_BLOB_DIR) as tmp:
+            tmp_path = tmp.name
+            try:
+                while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                    size += len(chunk)
+                    if size > max_size:
+                        break
+                    digest.update(chunk)
+                    tmp.write(chunk)
+            except BaseException:
+                # e.g. client disconnected mid-upload; don't leave the partial file
+                tmp.close()
+                os.remove(tmp_path)
+                raise
+
+        if size > max_size:
+            os.remove(tmp_path)
             raise HTTPException(
                 status_code=400,
                 detail=f"❌ File too large (max {max_size // (1024*1024)}MB)"
             )
-        
-        # Save to temporary file
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp:
-            tmp.write(content)
-            pdf_path = tmp.name
 
-        # Use filename as simple ID
-        pdf_id = os.path.basename(pdf_path)
+        # Blobs are named by content hash, so re-uploading a PDF reuses its file
+        pdf_path = os.path.join(PDF_BLOB_DIR, f"{digest.hexdigest()}.pdf")
+        if os.path.exists(pdf_path):
+            os.remove(tmp_path)
+        else:
+            os.replace(tmp_path, pdf_path)
+
+        # Each upload gets its own ID; registering it before indexing holds a
+        # reference so a concurrent delete can't remove the shared blob
+        pdf_id = uuid.uuid4().hex
+        uploaded_pdfs[pdf_id] = pdf_path
 
         # Warm-up cache (create vector + BM25 indexes) in background
         loop = asyncio.get_running_loop()
-        await loop.run_in_executor(None, get_or_create_indexes, pdf_path)
+        try:
+            await loop.run_in_executor(None, get_or_create_indexes, pdf_path)
+        except Exception:
+            if pdf_id in uploaded_pdfs:
+                del uploaded_pdfs[pdf_id]
+            raise
 
-        uploaded_pdfs[pdf_id] = pdf_path
         logger.info(f"✅ PDF uploaded: {pdf_id} ({file.filename})")
         
         return {
@@ -130,14 +213,25 @@ async def query_pdf(
     try:
         logger.info(f"📝 Query from session '{session_id}': {question[:50]}...")
         
-        # Run pipeline in executor to avoid blocking (WITH SESSION ID)
-        result = await loop.run_in_executor(
-            None,
-            run_full_pipeline,
-            question,
-            pdf_path,
-            session_id  # Pass session_id to pipeline
-        )
+        # Join an identical query that is already running, if any
+        query_key = query_cache_key(question, pdf_path, session_id)
+        pending = inflight_queries.get(query_key)
+        if pending is None:
+            # Run pipeline in executor to avoid blocking (WITH SESSION ID)
+            pending = loop.run_in_executor(
+                pipeline_executor,
+                run_full_pipeline,
+                question,
+                pdf_path,
+                session_id  # Pass session_id to pipeline
+            )
+            inflight_queries[query_key] = pending
+            pending.add_done_callback(lambda _: inflight_queries.pop(query_key, None))
+        else:
+            logger.info(f"🔁 Joining in-flight query for session '{session_id}'")
+
+        # Shield so one client disconnecting doesn't cancel the shared run
+        result = await asyncio.shield(pending)
         
         return {
             "answer": result["answer"],
@@ -205,16 +299,9 @@ async def delete_pdf(pdf_id: str):
             detail=f"❌ pdf_id '{pdf_id}' not found"
         )
     
-    pdf_path = uploaded_pdfs.pop(pdf_id)
-    
     try:
-        # Remove PDF file
-        if os.path.exists(pdf_path):
-            os.remove(pdf_path)
-        
-        # Clear from cache
-        if pdf_path in pdf_cache:
-            del pdf_cache[pdf_path]
+        # Removes the PDF file and clears it from the index cache
+        del uploaded_pdfs[pdf_id]
         
         logger.info(f"🗑️ Deleted PDF: {pdf_id}")
         return {
@@ -240,10 +327,16 @@ async def list_pdfs():
 # === Run Server ===
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 8000))
+    # Uploaded PDFs, sessions and caches live in process memory, so more than
+    # one worker only works behind a sticky load balancer
+    workers = int(os.environ.get("WORKERS", 1))
     uvicorn.run(
         "main:app",
         host="0.0.0.0",
         port=port,
-        reload=True,
+        workers=workers,
+        reload=os.environ.get("RELOAD", "false").lower() == "true",
+        loop="auto",  # uvloop when installed, asyncio otherwise (e.g. Windows)
+        http="auto",  # httptools when installed
         log_level="info"
     )
\ No newline at end of file